@@ -2,11 +2,16 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import altair as alt
-import time # Importamos la librería time para simular la actualización
+import hashlib
+import io
+import os
+import time
 
 # --- CONSTANTES Y CONFIGURACIÓN INICIAL ---
 # Nombre del archivo Excel del usuario. Debe estar en la misma carpeta que app.py
 ARCHIVO_DATOS = "para ID.xlsx" 
+# Versión del formato de la copia Parquet (columnas y tipos). ¡SUBIRLA SI CAMBIAN LAS COLUMNAS O TIPOS QUE GUARDA load_data!
+VERSION_PARQUET = 1
 
 # Nombres de las columnas, asumiendo que existen estos nombres en tu archivo Excel
 # ¡AJUSTA ESTAS CONSTANTES SI LOS NOMBRES DE COLUMNA EN TU EXCEL SON DIFERENTES!
@@ -27,32 +32,103 @@ CATEGORIAS_REFERENCIA = ['1 EQUIPO', 'SUB 17']
 st.set_page_config(layout="wide", page_title="Análisis Comparativo de Z-Scores")
 
 # Esquema de color para las categorías (ahora llamadas 'Categoría de Referencia')
-COLOR_SCHEME = alt.Scale(
-    domain=CATEGORIAS_REFERENCIA, 
-    range=['#1f77b4', '#ff7f0e'] # Azul para 1 EQUIPO, Naranja para SUB 17
-)
-
-# --- FUNCIÓN DE CARGA DE DATOS (SIN CACHÉ PARA ACTUALIZACIÓN) ---
-# Se elimina @st.cache_data para forzar la lectura del archivo en cada ejecución/interacción.
-def load_data(file_path):
-    """Carga y limpia el archivo Excel."""
+# Con @st.cache_resource el objeto de Altair se construye una sola vez por proceso y no en cada reejecución
+@st.cache_resource
+def _color_scheme():
+    return alt.Scale(
+        domain=CATEGORIAS_REFERENCIA, 
+        range=['#1f77b4', '#ff7f0e'] # Azul para 1 EQUIPO, Naranja para SUB 17
+    )
+
+# --- FUNCIÓN DE CARGA DE DATOS (CON CACHÉ POR FECHA DE MODIFICACIÓN) ---
+# La caché se invalida sola cuando cambia la fecha de modificación del Excel (parámetro mtime).
+# Los errores se propagan como excepciones: st.cache_data no las guarda, así que una lectura fallida
+# (p. ej. un Excel bloqueado justo al guardarlo) se vuelve a intentar en la siguiente interacción.
+@st.cache_data(show_spinner=False)
+def _load_data_cached(file_path, mtime):
+    """Carga y limpia el archivo Excel. 'mtime' solo se usa como clave de caché."""
+    # Copia en Parquet junto al Excel (p. ej. 'para ID.parquet'), válida mientras coincidan el hash del Excel y VERSION_PARQUET
+    ruta_base = os.path.splitext(file_path)[0]
+    ruta_parquet = ruta_base + '.parquet'
+    ruta_meta = ruta_base + '.meta'
+
+    # Leer el Excel una sola vez; si está bloqueado porque se acaba de guardar, se reintenta
+    # hasta 3 veces con una espera breve (sin coste extra cuando el archivo está libre)
+    for intento in range(3):
+        try:
+            with open(file_path, 'rb') as f:
+                contenido = f.read()
+            break
+        except PermissionError:
+            if intento == 2:
+                raise
+            time.sleep(0.05 * (intento + 1))
+    # La clave de la copia Parquet combina la versión del formato y el hash del Excel
+    clave_parquet = f"{VERSION_PARQUET}:{hashlib.sha1(contenido).hexdigest()}"
+
+    # Si la copia Parquet corresponde a este mismo Excel, se evita volver a parsearlo.
+    # Si la copia está dañada o no se puede leer, se ignora y se vuelve a leer el Excel
+    if os.path.exists(ruta_parquet) and os.path.exists(ruta_meta):
+        try:
+            with open(ruta_meta, encoding='utf-8') as f:
+                if f.read().strip() == clave_parquet:
+                    return pd.read_parquet(ruta_parquet)
+        except Exception:
+            pass
+
+    # Solo se leen las columnas que usa la app, ya con su tipo (el resto del Excel mezcla textos y números).
+    # Las métricas se guardan en float32: sobra precisión para Z-Scores mostrados con 3 decimales
     try:
-        # Se agrega un pequeño retraso para asegurar que el sistema de archivos haya liberado el Excel si acaba de ser guardado
-        time.sleep(0.5) 
-        
-        df = pd.read_excel(file_path, engine='openpyxl')
+        df = pd.read_excel(
+            io.BytesIO(contenido),
+            engine='calamine',
+            usecols=[COL_JUGADOR, COL_CATEGORIA] + COLS_ZSCORE,
+            dtype={COL_JUGADOR: 'string', COL_CATEGORIA: 'string', COL_RM_SENTADILLA: 'float32', COL_VO2_MAX: 'float32'}
+        )
+    except ValueError:
+        # Con usecols, una columna inexistente produce ValueError y no KeyError:
+        # se revisan los encabezados para mostrar el mensaje de columna faltante
+        columnas_excel = pd.read_excel(io.BytesIO(contenido), engine='calamine', nrows=0).columns
+        faltantes = [col for col in [COL_JUGADOR, COL_CATEGORIA] + COLS_ZSCORE if col not in columnas_excel]
+        if faltantes:
+            raise KeyError(faltantes[0])
+        raise
+
+    # Limpiar posibles espacios (las columnas ya son de tipo texto)
+    df[[COL_JUGADOR, COL_CATEGORIA]] = df[[COL_JUGADOR, COL_CATEGORIA]].apply(lambda s: s.str.strip())
+    
+    # Eliminar filas donde al menos una de las columnas clave esté vacía, con una sola máscara booleana
+    mask = df[COL_JUGADOR].notna() & df[COL_CATEGORIA].notna() & df[COLS_ZSCORE].notna().all(axis=1)
+    df = df.loc[mask].reset_index(drop=True)
 
-        # Convertir a cadena y limpiar posibles espacios
-        df[COL_JUGADOR] = df[COL_JUGADOR].astype(str).str.strip()
-        df[COL_CATEGORIA] = df[COL_CATEGORIA].astype(str).str.strip()
-        
-        # Eliminar filas donde al menos una de las columnas clave esté vacía
-        df.dropna(subset=[COL_JUGADOR, COL_CATEGORIA] + COLS_ZSCORE, inplace=True)
+    # Jugador y categoría como 'category': los filtros y agrupaciones trabajan sobre códigos enteros
+    df[COL_JUGADOR] = df[COL_JUGADOR].astype('category')
+    df[COL_CATEGORIA] = df[COL_CATEGORIA].astype('category')
 
-        return df
+    # Guardar la copia Parquet; si falla, la app sigue funcionando leyendo el Excel.
+    # El .meta anterior se borra primero para que nunca valide un Parquet a medio escribir o de otro Excel
+    try:
+        if os.path.exists(ruta_meta):
+            os.remove(ruta_meta)
+        df.to_parquet(ruta_parquet, compression='zstd')
+        with open(ruta_meta, 'w', encoding='utf-8') as f:
+            f.write(clave_parquet)
+    except Exception:
+        pass
+
+    return df
+
+def load_data(file_path, mtime):
+    """Devuelve los datos en caché o muestra el error correspondiente (sin guardarlo en caché) y un DataFrame vacío."""
+    try:
+        return _load_data_cached(file_path, mtime)
     except FileNotFoundError:
         st.error(f"Error: No se encontró el archivo '{file_path}'. Asegúrate de que está en la misma carpeta que 'app.py'.")
         return pd.DataFrame()
+    except PermissionError:
+        # El Excel sigue bloqueado tras los reintentos: como el error no queda en caché, se vuelve a leer en la próxima interacción
+        st.warning(f"El archivo '{file_path}' está en uso (por ejemplo, guardándose en Excel). Espera un momento y presiona **Actualizar** o interactúa con los filtros para reintentar.")
+        return pd.DataFrame()
     except KeyError as e:
         st.error(f"Error: La columna {e} no se encuentra en el archivo Excel. Verifica los nombres de columna en las constantes de 'app.py'.")
         return pd.DataFrame()
@@ -60,59 +136,73 @@ def load_data(file_path):
         st.error(f"Ocurrió un error al cargar los datos: {e}")
         return pd.DataFrame()
 
-# --- FUNCIÓN DE CÁLCULO DE DOBLE Z-SCORE ---
-def calculate_dual_zscore(df, target_players, reference_categories, value_cols):
+# --- FUNCIONES AUXILIARES ---
+def _gb(df, keys):
+    """Agrupa con observed=True para no generar grupos vacíos por cada valor posible de las columnas 'category'."""
+    return df.groupby(keys, observed=True, sort=False)
+
+def _cat_isin(series, values):
+    """Equivalente a series.isin(values) para columnas 'category', comparando códigos enteros en lugar de textos."""
+    codes = series.cat.categories.get_indexer(list(values))
+    return np.isin(series.cat.codes.to_numpy(), codes[codes >= 0])
+
+# --- FUNCIÓN DE ESTADÍSTICAS POR CATEGORÍA (CON CACHÉ) ---
+# Solo depende de los datos cargados, así que se calcula una vez y no en cada interacción con los filtros.
+@st.cache_data(show_spinner=False)
+def compute_ref_stats(df):
+    """Calcula la media y desviación estándar (STD) de las métricas de cada categoría en una sola pasada."""
+    return _gb(df, COL_CATEGORIA)[COLS_ZSCORE].agg(['mean', 'std'])
+
+# --- LISTA DE JUGADORES (CON CACHÉ) ---
+# Igual que las estadísticas, solo cambia cuando cambian los datos.
+@st.cache_data(show_spinner=False)
+def _sorted_players(df):
+    """Devuelve la lista ordenada de jugadores presentes en los datos."""
+    return sorted(df[COL_JUGADOR].unique().tolist())
+
+# --- FUNCIÓN DE CÁLCULO DE DOBLE Z-SCORE (CON CACHÉ POR SELECCIÓN) ---
+# Streamlit usa como clave el contenido del DataFrame y las selecciones, así que repetir una selección no recalcula nada.
+@st.cache_data(show_spinner=False)
+def calculate_dual_zscore(df, stats, target_players, reference_categories, value_cols):
     """
     Calcula el Z-Score de los jugadores objetivo contra las estadísticas (media/std)
-    de cada una de las categorías de referencia.
+    de cada una de las categorías de referencia, tomadas de 'stats' (ver compute_ref_stats).
+    Devuelve el resultado en formato largo (Jugador, Referencia, Métrica, Z_Score), listo para graficar.
     """
     
-    # 1. Filtrar solo los jugadores objetivo (CALAGUA, OJEDA, ZEGARRA)
-    df_targets = df[df[COL_JUGADOR].isin(target_players)].copy()
-    
-    # Lista para almacenar los resultados de cada comparación
-    all_comparisons = []
-
-    for ref_cat in reference_categories:
-        # 2. Obtener la población de referencia para la categoría actual
-        df_reference = df[df[COL_CATEGORIA] == ref_cat]
-        
-        if df_reference.empty:
-            continue
-
-        # 3. Calcular la media y desviación estándar (STD) para la categoría de referencia
-        stats = df_reference[value_cols].agg(['mean', 'std']).T
-        stats.columns = ['mean', 'std']
-        
-        # 4. Calcular el Z-Score de los jugadores objetivo contra estas estadísticas
-        df_cat_zscore = df_targets.copy()
-        
-        for col in value_cols:
-            mean = stats.loc[col, 'mean']
-            std = stats.loc[col, 'std']
-            
-            new_col_name = f'Z-Score {col}'
-            
-            # Cálculo de Z-Score: (Valor - Media) / Desviación Estándar
-            if std == 0 or np.isnan(std):
-                # Si la desviación es cero (todos los valores son iguales), el Z-Score es 0
-                df_cat_zscore[new_col_name] = 0
-            else:
-                df_cat_zscore[new_col_name] = (df_cat_zscore[col] - mean) / std
-        
-        # 5. Agregar una columna que indica la categoría de referencia utilizada
-        df_cat_zscore['Categoría de Referencia'] = ref_cat
-        all_comparisons.append(df_cat_zscore)
-
-    if not all_comparisons:
+    # 1. Las categorías de referencia sin datos se omiten, manteniendo el orden solicitado
+    ref_cats = [ref_cat for ref_cat in reference_categories if ref_cat in stats.index]
+    if not ref_cats:
         return pd.DataFrame()
 
-    # 6. Combinar todos los resultados en un solo DataFrame
-    df_final = pd.concat(all_comparisons, ignore_index=True)
+    # 2. Filtrar solo los jugadores objetivo (CALAGUA, OJEDA, ZEGARRA), sin copiar el DataFrame
+    mask_targets = _cat_isin(df[COL_JUGADOR], target_players)
+    players = df.loc[mask_targets, COL_JUGADOR].to_numpy()
+    targets_arr = df.loc[mask_targets, value_cols].to_numpy(dtype=np.float32)
+    
+    # 3. Media y STD por categoría de referencia: matrices (categorías x métricas)
+    means = stats.xs('mean', axis=1, level=1).loc[ref_cats, value_cols].to_numpy(dtype=np.float32)
+    stds = stats.xs('std', axis=1, level=1).loc[ref_cats, value_cols].to_numpy(dtype=np.float32)
+    
+    # Si la desviación es cero (todos los valores son iguales) o no existe, se divide por 1 y luego el Z-Score se fija en 0
+    invalid = (stds == 0) | np.isnan(stds)
+    safe_stds = np.where(invalid, np.float32(1), stds)
+    
+    # 4. Calcular el Z-Score de todas las combinaciones a la vez: (Valor - Media) / Desviación Estándar
+    # El resultado tiene forma (categorías, jugadores, métricas)
+    zscores = (targets_arr[None, :, :] - means[:, None, :]) / safe_stds[:, None, :]
+    zscores[np.broadcast_to(invalid[:, None, :], zscores.shape)] = 0
     
-    # Limpiar columnas originales de valor para evitar confusiones
-    cols_to_drop = [col for col in value_cols if col in df_final.columns]
-    return df_final.drop(columns=cols_to_drop, errors='ignore')
+    # 5. Construir el resultado directamente en formato largo: una fila por (categoría, jugador, métrica)
+    # Referencia y Métrica se crean como 'category' directamente desde sus códigos, para filtrarlas sin comparar textos.
+    # Todas las columnas se generan ya con su tamaño final, así que el DataFrame las usa sin copiarlas (copy=False)
+    n_refs, n_players, n_metrics = zscores.shape
+    return pd.DataFrame({
+        COL_JUGADOR: np.tile(np.repeat(players, n_metrics), n_refs),
+        'Referencia': pd.Categorical.from_codes(np.repeat(np.arange(n_refs), n_players * n_metrics), categories=ref_cats),
+        'Métrica': pd.Categorical.from_codes(np.tile(np.arange(n_metrics), n_refs * n_players), categories=list(value_cols)),
+        'Z_Score': zscores.ravel(),
+    }, copy=False)
 
 # --- LÓGICA PRINCIPAL DE STREAMLIT ---
 def main():
@@ -128,26 +218,39 @@ def main():
     # --- BOTÓN DE RECARGA (Nuevo) ---
     col_button, col_spacer = st.columns([1, 4])
     with col_button:
-        # Al presionar el botón, se fuerza una nueva ejecución del script
+        # Al presionar el botón, se vacía la caché y se fuerza una nueva ejecución del script
         if st.button("🔄 Actualizar Datos del Excel", help="Haz clic para recargar la información directamente desde 'para ID.xlsx'."):
+            st.cache_data.clear()
             st.rerun() # Comando para forzar la reejecución del script
     
     with col_spacer:
         st.info("Presiona el botón de **Actualizar** si has modificado y guardado el archivo Excel.")
 
     # 1. Cargar datos
-    # Como load_data no tiene caché, se ejecuta en cada interacción o al hacer clic en 'Actualizar'
-    data = load_data(ARCHIVO_DATOS)
+    # load_data está en caché: solo se vuelve a leer el Excel si cambió su fecha de modificación
+    # o si se hizo clic en 'Actualizar'
+    mtime = os.path.getmtime(ARCHIVO_DATOS) if os.path.exists(ARCHIVO_DATOS) else None
+    data = load_data(ARCHIVO_DATOS, mtime)
 
+    # Sin datos no hay nada que filtrar: se detiene la ejecución antes de construir la barra lateral
+    # (load_data ya mostró el error correspondiente)
     if data.empty:
-        return
+        st.stop()
+
+    # Estadísticas de referencia por categoría, fijas mientras no cambien los datos
+    stats = compute_ref_stats(data)
 
     # --- FILTRO DINÁMICO INTERACTIVO (Sidebar) ---
-    all_players = sorted(data[COL_JUGADOR].unique().tolist())
+    all_players = _sorted_players(data)
     all_metrics = [COL_RM_SENTADILLA, COL_VO2_MAX]
     
-    # Filtrar jugadores solo de la lista inicial
-    target_players_filtered = [p for p in JUGADORES_COMPARAR_DEFAULT if p in all_players]
+    # Filtrar jugadores solo de la lista inicial (búsqueda en un set)
+    all_players_set = set(all_players)
+    target_players_filtered = [p for p in JUGADORES_COMPARAR_DEFAULT if p in all_players_set]
+
+    if not target_players_filtered:
+        st.warning(f"Ninguno de los jugadores a comparar ({', '.join(JUGADORES_COMPARAR_DEFAULT)}) aparece en el archivo Excel.")
+        st.stop()
 
     st.sidebar.header("Filtros Interactivos")
     
@@ -177,50 +280,36 @@ def main():
 
     if not selected_players or not selected_references or not selected_metrics:
         st.info("Por favor, completa la selección de jugadores, referencias y métricas.")
-        return
+        st.stop()
 
     # 2. Calcular los Z-Scores con la lógica dual
+    # Las selecciones se pasan ordenadas para que la clave de caché no dependa del orden de clic.
+    # Se calculan siempre todas las métricas y no solo las seleccionadas: alternar métricas es la interacción
+    # más frecuente y así reutiliza el resultado en caché; calcular una métrica de más cuesta una columna
+    # extra en la misma operación vectorizada, mientras que pasar selected_metrics obligaría a recalcular en cada cambio.
     df_dual_zscore = calculate_dual_zscore(
         data, 
-        selected_players, 
-        selected_references, 
+        stats, 
+        sorted(selected_players), 
+        sorted(selected_references), 
         all_metrics # Se usan todas las métricas para el cálculo, luego filtramos para la visualización
     )
 
     if df_dual_zscore.empty:
         st.warning("No hay datos disponibles para la combinación de jugadores y categorías de referencia seleccionadas.")
-        return
+        st.stop()
 
-    # 3. Preparar datos para el gráfico
-    
-    # Lista de columnas Z-Score para las métricas seleccionadas
-    zscore_cols_to_melt = [f'Z-Score {col}' for col in selected_metrics]
-
-    # Unpivot para tener las métricas en una sola columna
-    df_chart = df_dual_zscore.melt(
-        id_vars=[COL_JUGADOR, 'Categoría de Referencia'],
-        value_vars=zscore_cols_to_melt,
-        var_name='Métrica',
-        value_name='Z_Score'
-    )
-    
-    # Limpiar nombres de las métricas para el gráfico
-    df_chart['Métrica'] = df_chart['Métrica'].str.replace('Z-Score ', '')
-    df_chart = df_chart.rename(columns={'Categoría de Referencia': 'Referencia'})
+    # 3. Preparar datos para el gráfico: el resultado ya viene en formato largo,
+    # solo se conservan las métricas seleccionadas (un único filtro por códigos, sin copias por métrica)
+    df_chart = df_dual_zscore[_cat_isin(df_dual_zscore['Métrica'], selected_metrics)]
 
     # --- FUNCIÓN DE GENERACIÓN DE GRÁFICOS (Modularizada) ---
 
-    def create_comparison_chart(data, metric_name=None):
-        
-        if metric_name:
-            chart_data = data[data['Métrica'] == metric_name].copy()
-            chart_title = f"Z-Score Comparativo: {metric_name}"
-        else:
-            chart_data = data.copy()
-            chart_title = "Z-Score Agrupado por Jugador y Métrica"
+    def create_comparison_chart(data):
+        # Todas las capas comparten los datos del gráfico para poder dividirlo por métrica (faceting)
 
         # 1. Gráfico de Barras
-        chart_bars = alt.Chart(chart_data).mark_bar().encode(
+        chart_bars = alt.Chart().mark_bar().encode(
             # Eje X: Jugador (se usa como el grupo principal de barras)
             x=alt.X(COL_JUGADOR, title='Jugador'),
             
@@ -231,23 +320,22 @@ def main():
             y=alt.Y('Z_Score', title='Puntuación Z (Z-Score)', scale=alt.Scale(domain=[-3, 3])),
             
             # Color: REFERENCIA
-            color=alt.Color('Referencia', title='Referencia', scale=COLOR_SCHEME),
+            color=alt.Color('Referencia', title='Referencia', scale=_color_scheme()),
             
             tooltip=[COL_JUGADOR, 'Referencia', 'Métrica', alt.Tooltip('Z_Score', format=".3f")]
         ).properties(
-            title=chart_title,
             # Ajustar tamaño de las barras para el agrupamiento
             width=alt.Step(90) 
         ) 
 
         # 2. Línea Cero (Media)
-        zero_line = alt.Chart(pd.DataFrame({'Z_Score': [0]})).mark_rule(color='red', strokeDash=[5,5]).encode(
-            y='Z_Score'
+        zero_line = alt.Chart().mark_rule(color='red', strokeDash=[5,5]).encode(
+            y=alt.datum(0)
         )
 
         # 3. Etiquetas de Texto (Valor del Z-Score)
         # Usamos text para visualizar el valor exacto
-        text_labels = alt.Chart(chart_data).mark_text(
+        text_labels = alt.Chart().mark_text(
             align='center',
             baseline='middle',
             dy=alt.expr("datum.Z_Score < 0 ? 15 : -10"), # Mover etiqueta arriba o abajo de la barra
@@ -262,34 +350,32 @@ def main():
             opacity=alt.condition(alt.datum.Z_Score != 0, alt.value(1), alt.value(0)) # Ocultar si es 0
         )
         
-        # 4. Combinar (Layer) todo
-        final_chart = (chart_bars + zero_line + text_labels).interactive()
+        # 4. Combinar (Layer) todo y separar una fila por métrica con un único gráfico (faceting)
+        final_chart = alt.layer(chart_bars, zero_line, text_labels, data=data).interactive().facet(
+            row=alt.Row(
+                'Métrica',
+                title=None,
+                sort=selected_metrics,
+                # El encabezado de cada fila reemplaza al título que antes tenía cada gráfico
+                header=alt.Header(
+                    labelExpr="'Z-Score Comparativo: ' + datum.value",
+                    labelOrient='top', labelAngle=0, labelAnchor='start', labelAlign='left',
+                    labelFontSize=13, labelFontWeight='bold'
+                )
+            )
+        ).resolve_scale(
+            y='shared' # Mantenemos la escala Y compartida para comparación visual
+        )
         
         return final_chart
     
     # --- CONSTRUCCIÓN FINAL ---
 
-    charts = []
+    final_visualization = create_comparison_chart(df_chart).configure_legend(
+        orient="top", titleOrient="left"
+    )
     
-    if len(selected_metrics) == 1:
-        # Si solo se selecciona una métrica, la mostramos en un gráfico grande
-        chart = create_comparison_chart(df_chart, selected_metrics[0])
-        charts.append(chart)
-    else:
-        # Si se seleccionan dos métricas, usamos Faceting/Concatenación para separarlas visualmente
-        for metric in selected_metrics:
-            charts.append(create_comparison_chart(df_chart, metric))
-
-    if charts:
-        # Concatenar todos los gráficos verticalmente
-        final_visualization = alt.vconcat(*charts).resolve_scale(
-            x='independent', # Mantenemos ejes X independientes si son métricas diferentes
-            y='shared' # Mantenemos la escala Y compartida para comparación visual
-        ).configure_legend(
-            orient="top", titleOrient="left"
-        )
-        
-        st.altair_chart(final_visualization, use_container_width=True)
+    st.altair_chart(final_visualization, use_container_width=True)
     
     # Nota de ayuda para la interpretación
     st.markdown("""